@@ -18,8 +18,16 @@ Authors:
     DB_HOST: Host of Mongo database.
     DB_NAME: Name of database.
     ALLOW_DOUBLE: (true | false) if true, can insert multiple documents withe same file ID (unique Net, Sta, Cha, Loc, Day)
+    COMPRESSORS: Optional wire protocol compressors (e.g. "zlib" or "zstd"), empty (default) for no compression
+    LOG_INDEX_STATS: (true | false) log index usage from $indexStats when connecting
+    UNACKNOWLEDGED_WRITES: (true | false) write hourly granules and continuous segments without waiting for acknowledgement
   ARCHIVE_ROOT: Root of the archive (e.g. "/path/to/archive/SDS/"). The following subdirectories are the archived years.
   DEFAULT_LOG_FILE: Path to log for writing.
+  WORKERS: Number of processes computing metadata in parallel (1 processes files serially)
+  SCAN_THREADS: Number of threads listing archive directories when collecting files by date
+  INODE_ORDER: (true | false) traverse directories and files in inode order to reduce seeks on HDDs
+  CHECKSUM_ALGO: (md5 | sha256 | blake3) algorithm for the file checksums used in change detection
+  HASH_DIRECT_IO: (true | false) read files with O_DIRECT when hashing to keep the page cache clean
   FILTERS:
     WHITE: Array of strings used for fnmatch (default ["*"] for everything)
     BLACK: Array of strings used for fnmatch (has precedent over white list)
@@ -82,18 +90,60 @@ import json
 import logging
 import argparse
 import datetime
+import errno
 import hashlib
+import io
+import mmap
 import warnings
 import sys
 import fnmatch
+import re
 import signal
+import subprocess
+import threading
 import glob
+import heapq
+import itertools
 
-def handler(signum, frame):
-  raise Exception("Metric calculation has timed out")
+# Monotonic clock for timing, available from Python 3.3
+try:
+  from time import perf_counter
+except ImportError:
+  from time import time as perf_counter
+
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+# Workers inherit the collector, which can not be pickled, so the
+# fork start method is required (UNIX only). Python 2 always forks
+try:
+  forkContext = multiprocessing.get_context('fork')
+except AttributeError:
+  forkContext = multiprocessing
+
+# md5sum is used for files larger than MD5SUM_MIN_SIZE bytes
+try:
+  from shutil import which
+except ImportError:
+  from distutils.spawn import find_executable as which
+
+MD5SUM = which('md5sum')
+MD5SUM_MIN_SIZE = 64 << 20
+
+# os.scandir is available from Python 3.5, use the backport before
+try:
+  from os import scandir
+except ImportError:
+  from scandir import scandir
 
 from logging.handlers import TimedRotatingFileHandler
 
+# Workers send log records to the parent process, available from Python 3.2
+try:
+  from logging.handlers import QueueHandler, QueueListener
+except ImportError:
+  QueueHandler = QueueListener = None
+
 # ObsPy mSEED-QC is required
 try:
   from obspy.signal.quality_control import MSEEDMetadata
@@ -105,14 +155,284 @@ cfg_dir = os.path.dirname(os.path.realpath(__file__))
 with open(os.path.join(cfg_dir, 'config.json'), "r") as cfg:
   CONFIG = json.load(cfg)
 
+# Defaults for options that configurations of
+# earlier versions of the collector do not have
+CONFIG.setdefault('WORKERS', 1)
+CONFIG.setdefault('SCAN_THREADS', 1)
+CONFIG.setdefault('INODE_ORDER', False)
+CONFIG.setdefault('CHECKSUM_ALGO', 'md5')
+CONFIG.setdefault('HASH_DIRECT_IO', False)
+CONFIG['MONGO'].setdefault('COMPRESSORS', '')
+CONFIG['MONGO'].setdefault('UNACKNOWLEDGED_WRITES', False)
+CONFIG['MONGO'].setdefault('LOG_INDEX_STATS', False)
+
 if CONFIG['MONGO']['ENABLED']:
-  from pymongo import MongoClient
+  from bson.objectid import ObjectId
+  from pymongo import MongoClient, InsertOne, ReplaceOne, WriteConcern
+  from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+
+# BLAKE3 checksums are optional
+if CONFIG['CHECKSUM_ALGO'] == 'blake3':
+  from blake3 import blake3
+
+def handler(signum, frame):
+  raise Exception("Metric calculation has timed out")
+
+def _installTimeoutHandler():
+  """
+  _installTimeoutHandler
+  > registers the timeout handler for this process
+  > signals can only be registered from the main thread
+  """
+  try:
+    signal.signal(signal.SIGALRM, handler)
+  except ValueError:
+    pass
+
+def walkFiles(directory, followlinks=False, match=None, inodeOrder=False):
+  """
+  walkFiles
+  > yields the paths of all files below a directory
+  > file types are taken from the directory entries
+  > so no additional stat call is made per file
+  > match optionally filters on the file name
+  > unreadable directories are skipped like os.walk does
+  > inodeOrder visits directories and files in ascending inode
+  > order, which approximates the on-disk layout on HDDs
+  """
+  stack = [(0, directory)]
+  while stack:
+    if inodeOrder:
+      inode, path = heapq.heappop(stack)
+    else:
+      inode, path = stack.pop()
+    try:
+      entries = scandir(path)
+    except OSError:
+      continue
+    files = []
+    try:
+      for entry in entries:
+        if entry.is_dir(follow_symlinks=followlinks):
+          if inodeOrder:
+            heapq.heappush(stack, (entry.inode(), entry.path))
+          else:
+            stack.append((0, entry.path))
+        elif (match is None or match(entry.name)) and entry.is_file():
+          if inodeOrder:
+            files.append((entry.inode(), entry.path))
+          else:
+            yield entry.path
+    finally:
+      closeEntries(entries)
+    for inode, path in sorted(files):
+      yield path
+
+def listEntries(directory):
+  """
+  listEntries
+  > returns the entries of a directory and closes
+  > the directory instead of waiting for garbage collection
+  """
+  entries = scandir(directory)
+  try:
+    return list(entries)
+  finally:
+    closeEntries(entries)
+
+def closeEntries(entries):
+  """
+  closeEntries
+  > closes a scandir iterator, which is not possible
+  > before Python 3.6 and with the scandir backport
+  """
+  if hasattr(entries, 'close'):
+    entries.close()
+
+def sortByInode(entries):
+  """
+  sortByInode
+  > returns directory entries in ascending inode order
+  """
+  return sorted(entries, key=lambda entry: entry.inode())
+
+def largestFirst(files):
+  """
+  largestFirst
+  > returns files sorted by size in descending order
+  """
+  def size(file):
+    try:
+      return os.path.getsize(file)
+    except OSError:
+      return 0
+
+  return sorted(files, key=size, reverse=True)
+
+def inBatches(items, size=1000):
+  """
+  inBatches
+  > yields lists of at most size items, used to keep $in
+  > queries below the 16 MiB BSON document limit
+  """
+  items = iter(items)
+  while True:
+    batch = list(itertools.islice(items, size))
+    if len(batch) == 0:
+      return
+    yield batch
+
+# Collector used by the worker processes
+_worker = None
+
+def _initWorker(collector, logQueue=None):
+  """
+  _initWorker
+  > Pool initializer that keeps the collector inherited
+  > from the parent process (UNIX fork only)
+  > and drops the inherited database client
+  > log records are sent to logQueue when given
+  """
+  global _worker
+  _worker = collector
+  if logQueue is not None:
+    collector.log.removeHandler(collector.file_handler)
+    collector.log.addHandler(QueueHandler(logQueue))
+  _installTimeoutHandler()
+  collector.mongo._resetAfterFork()
+
+def _processFileWorker(task):
+  """
+  _processFileWorker
+  > computes the metadata of a single file in a worker process
+  """
+  counter, file = task
+  return _worker._processFile(counter, file)
+
+# Numeric document fields as (key, type, ObsPy metric)
+GRANULE_FIELDS = (
+  ('nsam', int, 'num_samples'),
+  ('smin', int, 'sample_min'),
+  ('smax', int, 'sample_max'),
+  ('smean', float, 'sample_mean'),
+  ('smedian', float, 'sample_median'),
+  ('supper', float, 'sample_upper_quartile'),
+  ('slower', float, 'sample_lower_quartile'),
+  ('rms', float, 'sample_rms'),
+  ('stdev', float, 'sample_stdev'),
+  ('ngaps', int, 'num_gaps'),
+  ('glen', float, 'sum_gaps'),
+  ('nover', int, 'num_overlaps'),
+  ('olen', float, 'sum_overlaps'),
+  ('avail', float, 'percent_availability')
+)
+
+# Numeric granule fields that may be None
+OPTIONAL_GRANULE_FIELDS = (
+  ('nrec', int, 'num_records'),
+  ('gmax', float, 'max_gap'),
+  ('omax', float, 'max_overlap')
+)
+
+CONTINUOUS_FIELDS = (
+  ('smin', int, 'sample_min'),
+  ('smax', int, 'sample_max'),
+  ('smean', float, 'sample_mean'),
+  ('smedian', float, 'sample_median'),
+  ('stdev', float, 'sample_stdev'),
+  ('rms', float, 'sample_rms'),
+  ('supper', float, 'sample_upper_quartile'),
+  ('slower', float, 'sample_lower_quartile'),
+  ('nsam', int, 'num_samples'),
+  ('srate', float, 'sample_rate'),
+  ('slen', float, 'segment_length')
+)
+
+# mSEED header flag percentages as (key, ObsPy flag) per flag type
+FLAG_FIELDS = {
+  'activity_flags': (
+    ('cas', 'calibration_signal'),
+    ('tca', 'time_correction_applied'),
+    ('evb', 'event_begin'),
+    ('eve', 'event_end'),
+    ('eip', 'event_in_progress'),
+    ('pol', 'positive_leap'),
+    ('nel', 'negative_leap')
+  ),
+  'data_quality_flags': (
+    ('asa', 'amplifier_saturation'),
+    ('dic', 'digitizer_clipping'),
+    ('spi', 'spikes'),
+    ('gli', 'glitches'),
+    ('mpd', 'missing_padded_data'),
+    ('tse', 'telemetry_sync_error'),
+    ('dfc', 'digital_filter_charging'),
+    ('stt', 'suspect_time_tag')
+  ),
+  'io_and_clock_flags': (
+    ('svo', 'station_volume'),
+    ('lrr', 'long_record_read'),
+    ('srr', 'short_record_read'),
+    ('sts', 'start_time_series'),
+    ('ets', 'end_time_series'),
+    ('clo', 'clock_locked')
+  )
+}
+
+# Document keys of the flag types
+FLAG_KEYS = (
+  ('io_flags', 'io_and_clock_flags'),
+  ('dq_flags', 'data_quality_flags'),
+  ('ac_flags', 'activity_flags')
+)
+
+# Timing quality as (key, ObsPy metric)
+TIMING_QUALITY_FIELDS = (
+  ('tqmin', 'timing_quality_min'),
+  ('tqmax', 'timing_quality_max'),
+  ('tqmean', 'timing_quality_mean'),
+  ('tqmedian', 'timing_quality_median'),
+  ('tqupper', 'timing_quality_upper_quartile'),
+  ('tqlower', 'timing_quality_lower_quartile')
+)
+
+def getHeaderDocument(header):
+  """
+  getHeaderDocument
+  > returns timing quality, timing correction and flag percentages
+  > from the miniseed header percentages in a single document
+  """
+
+  # Add the timing correction
+  document = {'tcorr': float(header['timing_correction'])}
+
+  # Check if the minimum is None, so is the rest
+  # otherwise convert to floats
+  if header['timing_quality_min'] is None:
+    for key, metric in TIMING_QUALITY_FIELDS:
+      document[key] = None
+  else:
+    for key, metric in TIMING_QUALITY_FIELDS:
+      document[key] = float(header[metric])
+
+  # Make sure the flags are floats
+  for key, flag_type in FLAG_KEYS:
+    flags = header[flag_type]
+    document[key] = {flag_key: float(flags[flag]) for flag_key, flag in FLAG_FIELDS[flag_type]}
+
+  return document
 
 class WFCatalogCollector():
   """
   WFCatalogCollector class for ingesting waveform metadata
   """
 
+  # File names in the archive structures
+  # ODC: STA.CHA.NET.YEAR.JDAY
+  # SDS: NET.STA.LOC.CHA.TYPE.YEAR.JDAY
+  _ODC_RE = re.compile(r'^(?P<station>[^.]*)\.(?P<channel>[^.]*)\.(?P<network>[^.]*)\.(?P<year>[^.]*)\.(?P<jday>[^.]*)$')
+  _SDS_RE = re.compile(r'^(?P<network>[^.]*)\.(?P<station>[^.]*)\.(?P<location>[^.]*)\.(?P<channel>[^.]*)\.(?P<dtype>[^.]*)\.(?P<year>[^.]*)\.(?P<jday>[^.]*)$')
+
   def __init__(self, logfile=None):
     """
     WFCatalogCollector.__init__
@@ -121,6 +441,24 @@ class WFCatalogCollector():
     self.mongo = MongoDatabase()
     self._setupLogger(logfile)
 
+    # Checksums keyed by (path, mtime, size, algorithm) so
+    # every file is hashed at most once per run
+    self._checksum_cache = {}
+
+    # Archive paths keyed by file name
+    self._full_path_cache = {}
+
+    # Dublin Core data object identifiers keyed by file name
+    self._data_object_cache = {}
+
+    # Sets of file names keyed by archive directory, None
+    # for directories that were looked in only once
+    self._listing_cache = {}
+
+    # White and black lists as single regular expressions
+    self._whiteFilter = self._compileFilter(CONFIG['FILTERS']['WHITE'])
+    self._blackFilter = self._compileFilter(CONFIG['FILTERS']['BLACK'])
+
 
   def _setOptions(self, user_options):
     """
@@ -189,7 +527,12 @@ class WFCatalogCollector():
     > processes data with options
     """
 
-    self.timeInitialized = datetime.datetime.now()
+    self.timeInitialized = perf_counter()
+
+    _installTimeoutHandler()
+
+    # Directory listings may be outdated between runs
+    self._listing_cache = {}
 
     # Attempt connection to the database
     if not self.mongo._connected:
@@ -199,6 +542,10 @@ class WFCatalogCollector():
           self.log.info("Connection to the database has been established")
         except Exception as ex:
           self.log.critical("Could not establish connection to the database"); sys.exit(0)
+        if not CONFIG['MONGO']['ALLOW_DOUBLE'] and not self.mongo.uniqueFileIds:
+          self.log.warning("The fileId index is not unique: files are checked against the database before writing")
+        if CONFIG['MONGO']['LOG_INDEX_STATS']:
+          self._logIndexStats()
       else:
         self.log.info("Connection to the database is disabled");
 
@@ -216,9 +563,31 @@ class WFCatalogCollector():
     else:
       self._processFiles()
 
-    self.log.info("WFCollector synchronization completed in %s." % (datetime.datetime.now() - self.timeInitialized))
+    self.log.info("WFCollector synchronization completed in %.3fs." % (perf_counter() - self.timeInitialized))
       
 
+  def _logIndexStats(self):
+    """
+    WFCatalogCollector._logIndexStats
+    > logs index usage so indexes that only slow down inserts
+    > can be identified; counters are reset when mongod restarts
+    """
+
+    try:
+      stats = self.mongo.getIndexStats()
+    except Exception as ex:
+      self.log.info("Could not get index statistics: %s" % ex)
+      return
+
+    for collection, index, ops, since in stats:
+
+      # The _id index is always required
+      if index == '_id_':
+        continue
+
+      self.log.info("Index %s on %s used %d time(s) since %s" % (index, collection, ops, since))
+
+
   def _deleteFiles(self):
     """
     WFCatalogCollector._deleteFiles
@@ -226,16 +595,19 @@ class WFCatalogCollector():
     """
 
     update_files = []
+    deleted_files = set(self.files)
 
     for file in self.files:
 
       # Set update for dependents on the file to be deleted
       for documents in self.mongo.getDailyFilesById(file):
 
+        fullPath = self._getFullPath(documents["fileId"])
+
         # Make sure to not update self or any file included in deletion
-        if self._getFullPath(documents["fileId"]) not in self.files:
+        if fullPath not in deleted_files:
           self.log.info("Stage dependent file for update %s" % documents["fileId"])
-          update_files.append(self._getFullPath(documents["fileId"]))
+          update_files.append(fullPath)
 
       # Remove the document
       for document in self.mongo.getDocumentByFilename(file):
@@ -258,22 +630,126 @@ class WFCatalogCollector():
     """
     WFCatalogCollector._processFiles
     > Loop over all files added to the class
+    > metadata is computed by CONFIG['WORKERS'] processes
+    > and stored to the database by this process
+    """
+
+    tasks = enumerate(self.files, 1)
+    processed = 0
+
+    # Daemonic processes (e.g. multithreader.py workers) can not
+    # start a pool of their own and process their files serially
+    if CONFIG['WORKERS'] <= 1 or multiprocessing.current_process().daemon:
+      for counter, file in tasks:
+        processed += 1
+        documents = self._processFile(counter, file)
+        if documents is not None:
+          self._storeOutput(documents)
+      self._logProcessed(processed)
+      return
+
+    # Start the largest files first so they do not end up as
+    # stragglers on a single worker at the end of the run
+    if isinstance(self.files, (list, set)):
+      tasks = enumerate(largestFirst(self.files), 1)
+
+    # The pool drains its input into an unbounded queue, so only hand
+    # out a new file when a result has been collected. This keeps
+    # streamed directory input from being read into memory at once
+    slots = threading.Semaphore(2 * CONFIG['WORKERS'])
+    stopped = threading.Event()
+
+    def gatedTasks(tasks):
+      for task in tasks:
+        slots.acquire()
+        if stopped.is_set():
+          return
+        yield task
+
+    # Log records of the workers are written by a single listener
+    # thread in this process instead of every worker writing to
+    # (and rotating) the inherited log file
+    logQueue = None
+    listener = None
+    if QueueListener is not None:
+      logQueue = forkContext.Queue(-1)
+      listener = QueueListener(logQueue, self.file_handler)
+
+    pool = forkContext.Pool(processes=CONFIG['WORKERS'], initializer=_initWorker, initargs=(self, logQueue))
+
+    # The listener thread is only started after the workers are
+    # forked so they do not inherit it or the locks it holds
+    if listener is not None:
+      listener.start()
+
+    # Documents are stored in completion order while the workers
+    # continue computing; results are buffered by the pool so
+    # database writes overlap with metadata computation
+    # Files are handed out one at a time as processing a file takes
+    # seconds and load balance matters more than dispatch overhead
+    try:
+      for documents in pool.imap_unordered(_processFileWorker, gatedTasks(tasks), chunksize=1):
+        slots.release()
+        processed += 1
+        if documents is not None:
+          self._storeOutput(documents)
+    finally:
+      # Wake up the feeder when it is waiting for a slot
+      stopped.set()
+      slots.release()
+      pool.close()
+      pool.join()
+      if listener is not None:
+        listener.stop()
+
+    self._logProcessed(processed)
+
+
+  def _logProcessed(self, processed):
+    """
+    WFCatalogCollector._logProcessed
+    > logs the number of processed files
     """
 
-    for file in self.files:
+    if processed == 0:
+      self.log.info("No files for processing: doing nothing.")
+    else:
+      self.log.info("Completed processing of %d file(s)" % processed)
+
+
+  def _processFile(self, counter, file):
+    """
+    WFCatalogCollector._processFile
+    > computes the metadata documents for a single file
+    """
+
+    self.file_counter = counter
+
+    fileStart = perf_counter()
 
-      fileStart = datetime.datetime.now()
+    self.log.info("Starting processing file %s", file)
 
-      self.log.info("Starting processing file %s", file)
+    try:
+      documents = self._collectMetadata(file)
+    except Exception as ex:
+      self.log.error("Could not compute metadata")
+      self.log.error(ex)
+      return None
 
+    # Database documents and checksums are built here so this
+    # work is done by the workers and not by the writing process
+    if documents is not None and CONFIG['MONGO']['ENABLED']:
       try:
-        self._collectMetadata(file)
+        documents = self._getDatabaseDocuments(documents)
       except Exception as ex:
-        self.log.error("Could not compute metadata")
-        self.log.error(ex)
-        continue
+        self.log.error("Could not parse daily granule document")
+        self.log.exception(ex)
+        return None
+
+    if self.log.isEnabledFor(logging.INFO):
+      self.log.info("Completed processing file in %.3fs" % (perf_counter() - fileStart))
 
-      self.log.info("Completed processing file in %s" % (datetime.datetime.now() - fileStart))
+    return documents
 
 
   def _passFilter(self, filename):
@@ -283,20 +759,29 @@ class WFCatalogCollector():
     > the blacklist had precedence over the whitelist
     """
 
-    for white_filter in CONFIG['FILTERS']['WHITE']:
-      # Match in the whitelist
-      if fnmatch.fnmatch(filename, white_filter):
-        # Check if overruled by blacklist
-        for black_filter in CONFIG['FILTERS']['BLACK']:
-          # Overruled, file is blacklisted
-          if fnmatch.fnmatch(filename, black_filter):
-            return False
+    # Default to false, not white listed so ignore
+    if self._whiteFilter is None or not self._whiteFilter.match(filename):
+      return False
+
+    # Overruled, file is blacklisted
+    if self._blackFilter is not None and self._blackFilter.match(filename):
+      return False
 
-        # Not overruled, file is whitelisted
-        return True
+    # Not overruled, file is whitelisted
+    return True
 
-    # Default to false, not white listed so ignore
-    return False
+
+  def _compileFilter(self, patterns):
+    """
+    WFCatalogCollector._compileFilter
+    > compiles a list of fnmatch patterns to a single
+    > regular expression (None for an empty list)
+    """
+
+    if len(patterns) == 0:
+      return None
+
+    return re.compile("|".join("(?:%s)" % fnmatch.translate(pattern) for pattern in patterns))
 
 
   def _setupLogger(self, logfile):
@@ -366,12 +851,8 @@ class WFCatalogCollector():
     now = datetime.datetime.now()
     start, end = self._getWindow()
 
-    # Loop over the window and collect files
-    pastFiles = []
-    for day in range(start, end):
-      pastFiles += self._collectFilesFromDate(now - datetime.timedelta(days=day))
-
-    return pastFiles
+    # Collect the files for all days in the window at once
+    return self._collectFilesFromDates([now - datetime.timedelta(days=day) for day in range(start, end)])
 
 
   def _collectFilesFromDate(self, date):
@@ -380,31 +861,80 @@ class WFCatalogCollector():
     > collects the files for a given year and day
     """
 
-    # Get the year & day of year
-    jday = date.strftime("%j")
-    year = date.strftime("%Y")
+    return self._collectFilesFromDates([date])
 
-    # ODC directory structure makes it simple to loop over years and days
-    if CONFIG['STRUCTURE'] == 'ODC':
-      directory = os.path.join(CONFIG['ARCHIVE_ROOT'], year, jday)
-      collectedFiles = [os.path.join(directory, f) for f in os.listdir(directory) if os.path.isfile(os.path.join(directory, f))]
 
-    # SDS structure is slightly more complex, loop over all directories
-    # in a year and extract files ending with a given jday
-    elif CONFIG['STRUCTURE'] == 'SDS':
-      collectedFiles = []
-      directory = os.path.join(CONFIG['ARCHIVE_ROOT'], year)
-      for subdir, dirs, files in os.walk(directory, followlinks=True):
-        for file in files:
-          if file.endswith(jday) and os.path.isfile(os.path.join(subdir, file)):
-            collectedFiles.append(os.path.join(subdir, file))
-    
-    else:
-      raise Exception("WFCatalogCollector.getFilesFromDirectory: unknown directory structure.")
+  def _collectFilesFromDates(self, dates):
+    """
+    WFCatalogCollector._collectFilesFromDates
+    > collects the files for multiple days listing
+    > every archive directory only once
+    """
+
+    # Group the days of year by year
+    jdays = {}
+    for date in dates:
+      jdays.setdefault('%04d' % date.year, set()).add('%03d' % date.timetuple().tm_yday)
+
+    collectedFiles = []
+
+    for year in sorted(jdays):
+
+      # ODC directory structure makes it simple to loop over years and days
+      if CONFIG['STRUCTURE'] == 'ODC':
+        for jday in sorted(jdays[year]):
+          directory = os.path.join(CONFIG['ARCHIVE_ROOT'], year, jday)
+          entries = listEntries(directory)
+          if CONFIG['INODE_ORDER']:
+            entries = sortByInode(entries)
+          collectedFiles += [entry.path for entry in entries if entry.is_file()]
+
+      # SDS structure is slightly more complex, match the files ending with
+      # any of the jdays in all YEAR/NET/STA/CHAN.TYPE directories of a year
+      elif CONFIG['STRUCTURE'] == 'SDS':
+        directories = glob.glob(os.path.join(CONFIG['ARCHIVE_ROOT'], year, '*', '*', '*', ''))
+        for files in self._mapDirectories(self._listDayFiles, directories, jdays[year]):
+          collectedFiles += files
+
+      else:
+        raise Exception("WFCatalogCollector.getFilesFromDirectory: unknown directory structure.")
 
     return collectedFiles
 
 
+  def _mapDirectories(self, function, directories, *args):
+    """
+    WFCatalogCollector._mapDirectories
+    > applies function to every directory, using CONFIG['SCAN_THREADS']
+    > threads so directory listings on network storage overlap
+    """
+
+    if CONFIG['SCAN_THREADS'] <= 1 or len(directories) <= 1:
+      return [function(directory, *args) for directory in directories]
+
+    pool = ThreadPool(min(CONFIG['SCAN_THREADS'], len(directories)))
+
+    try:
+      return pool.map(lambda directory: function(directory, *args), directories)
+    finally:
+      pool.close()
+      pool.join()
+
+
+  def _listDayFiles(self, directory, jdays):
+    """
+    WFCatalogCollector._listDayFiles
+    > returns the files in a directory ending with any of the jdays
+    """
+
+    entries = listEntries(directory)
+
+    if CONFIG['INODE_ORDER']:
+      entries = sortByInode(entries)
+
+    return [entry.path for entry in entries if os.path.splitext(entry.name)[1][1:] in jdays and entry.is_file()]
+
+
   def _getFiles(self):
     """
     WFCatalogCollector._getFiles
@@ -428,9 +958,12 @@ class WFCatalogCollector():
       if not os.path.isdir(self.args['dir']):
         raise Exception("Input is not a valid directory on the file system.")
 
-      # Collect all the files (recursively) from a directory and add them
-      self.files = [os.path.join(root, f) for root, dirs, files in os.walk(self.args['dir']) for f in files if os.path.isfile(os.path.join(root, f))]
-      self.log.info("Collected %d file(s) from directory %s" % (len(self.files), self.args['dir']))
+      # Collect all the files (recursively) from a directory, these
+      # are streamed to processing rather than collected up front
+      # The white and black lists are applied during the walk so
+      # file names that are filtered out are never passed on
+      self.files = walkFiles(self.args['dir'], match=self._passFilter, inodeOrder=CONFIG['INODE_ORDER'])
+      self.log.info("Collecting files from directory %s" % self.args['dir'])
 
     # If globbing match all files
     elif self.args['glob']:
@@ -447,15 +980,11 @@ class WFCatalogCollector():
 
     # Specific date as input (with optional range)
     elif self.args['date']:
-      self.files = []
       specific_date = datetime.datetime.strptime(self.args['date'], "%Y-%m-%d")
       n_days = int(self.args['range'])
+      direction = 1 if n_days > 0 else -1
       # Include a given range (default to 1)
-      for day in range(abs(n_days)):
-        if n_days > 0:
-          self.files += self._collectFilesFromDate(specific_date + datetime.timedelta(days=day))
-        else:
-          self.files += self._collectFilesFromDate(specific_date - datetime.timedelta(days=day))
+      self.files = self._collectFilesFromDates([specific_date + datetime.timedelta(days=direction * day) for day in range(abs(n_days))])
       self.log.info("Collected %d file(s) from date %s +%d days" % (len(self.files), self.args['date'], n_days))
 
     # Raise on no input
@@ -482,14 +1011,25 @@ class WFCatalogCollector():
     # Validate the white and black list
     self._validateFilters()
 
-    self.files = [f for f in self.files if self._passFilter(os.path.basename(f))]
+    # Directory walks are already filtered
+    if not self.args['dir']:
+      self.files = (f for f in self.files if self._passFilter(os.path.basename(f)))
+
+    # Files from a directory are streamed when only adding new files
+    if self.args['dir'] and not self.args['delete'] and not self.args['update']:
+      self.files = self._iterNewFiles(self.files)
+      self.totalFiles = None
+      self.log.info("Begin processing of new file(s) from directory")
+      return
+
+    self.files = list(self.files)
 
     # Return immediately if deleting 
     if self.args['delete']:
       return
 
     # Get the new files from the directory that are not in the database
-    new_files = [file for file in self.files if self._isNewDocument(file)]
+    new_files = self._getNewFiles(self.files)
     self.log.info("Discovered %d new file(s) for processing" % (len(new_files)))
 
     # If we are updating, remove old documents and add changed document to the process list
@@ -512,54 +1052,116 @@ class WFCatalogCollector():
       self.log.info("No files for processing: doing nothing."); sys.exit(0)
 
 
+  def _getNewFiles(self, files):
+    """
+    WFCatalogCollector._getNewFiles
+    > returns the files that do not exist in the database
+    > querying the file identifiers in batches. If double is
+    > allowed this check is skipped.
+    """
+
+    if not CONFIG['MONGO']['ENABLED'] or CONFIG['MONGO']['ALLOW_DOUBLE']:
+      return list(files)
+
+    existing = self.mongo.getExistingFileIds(files)
+
+    return [f for f in files if os.path.basename(f) not in existing]
+
+
+  def _iterNewFiles(self, files):
+    """
+    WFCatalogCollector._iterNewFiles
+    > yields the files that do not exist in the database
+    > querying the database per batch of files
+    """
+
+    for batch in inBatches(files):
+      for file in self._getNewFiles(batch):
+        yield file
+
+
   def _getChangedFiles(self):
     """
     WFCatalogCollector._getChangedFiles
     > compares checksums in database against files in a directory
     """
 
-    changedFiles = []
+    changedFiles = set()
 
     if self.args['force']:
       self.log.info("Updating: forcing checksum change for database documents")
     else:
       self.log.info("Updating: start change detection through checksums of database documents")
 
+    # Get the documents that depend on the input files in batched
+    # queries and index the (document, used file) pairs by file name
+    # The full files array is used because a document can depend
+    # on more than one input file, and may be returned by more
+    # than one batch
+    basenames = set(os.path.basename(file) for file in self.files)
+    dependents = {}
+    seen = set()
+    for batch in inBatches(basenames):
+      for document in self.mongo.getDailyFilesByIds(batch):
+        if document['_id'] in seen:
+          continue
+        seen.add(document['_id'])
+        for used_files in document['files']:
+          if used_files['name'] in basenames:
+            dependents.setdefault(used_files['name'], []).append((document, used_files))
+
     # Go over all the files in the input
     for file in self.files:
+
+      # Files that no document depends on are not parsed or hashed
+      # as their names may not follow the archive structure
+      documents = dependents.get(os.path.basename(file))
+      if not documents:
+        continue
+
+      fullPath = None
+      checksums = {}
     
-      # Get the documents that depend on this file
-      # under document.files
-      for document in self.mongo.getDailyFilesById(file): 
+      for document, used_files in documents:
 
         # The document update is forced
         # We must update every document that depends on the file
         if self.args['force']:
           self.log.info("Forcing update on %s" % document["fileId"])
-          changedFiles.append(document["fileId"])
+          changedFiles.add(document["fileId"])
           continue
 
-        # Loop over all the used files
-        for used_files in document['files']:
+        if fullPath is None:
+          fullPath = self._getFullPath(os.path.basename(file))
+          fingerprint = self._getFingerprint(fullPath)
 
-          # If not forcing, just check the MD5 hash of the
-          # actual passed file, and the MD5 hash in the database
-          if used_files["name"] != os.path.basename(file):
-            continue
+        # If not forcing, first compare the size and modification time
+        # stored with the document and skip hashing when both match
+        if fingerprint is not None and fingerprint == (used_files.get('fsize'), used_files.get('fmtime_ns')):
+          self.log.info("Size and modification time unchanged for %s" % used_files['name'])
+          continue
 
-          self.log.info("Comparing MD5checksums for %s" % used_files['name'])
-          
-          fullPath = self._getFullPath(os.path.basename(file))
-          MD5Hash = self._getMD5Hash(fullPath)
+        # Otherwise check the hash of the actual
+        # passed file, and the hash in the database
+
+        # Documents without an algorithm were stored with md5
+        algorithm = used_files.get('algo', 'md5')
 
-          # Compare the checksum
-          if MD5Hash != used_files['chksm']:
+        self.log.info("Comparing %s checksums for %s" % (algorithm, used_files['name']))
 
-            self.log.info("Detected MD5checksum change for %s" % used_files['name'])
-            self.log.info("Adding file %s for updating" % document["fileId"])
-            changedFiles.append(document["fileId"])
+        # Hash the file only once for all dependent documents
+        # using the algorithm the document was stored with
+        if algorithm not in checksums:
+          checksums[algorithm] = self._cachedChecksum(fullPath, algorithm, fingerprint)
+
+        # Compare the checksum
+        if checksums[algorithm] != used_files['chksm']:
+
+          self.log.info("Detected %s checksum change for %s" % (algorithm, used_files['name']))
+          self.log.info("Adding file %s for updating" % document["fileId"])
+          changedFiles.add(document["fileId"])
     
-    return list(set([self._getFullPath(filename) for filename in changedFiles]))
+    return [self._getFullPath(filename) for filename in changedFiles]
      
       
   def _getFullPath(self, file):
@@ -569,7 +1171,10 @@ class WFCatalogCollector():
     > for file basename and directory stucture (config)
     """
 
-    return self._getFileDirectory(self._getStatsObject(file))
+    if file not in self._full_path_cache:
+      self._full_path_cache[file] = self._getFileDirectory(self._getStatsObject(file))
+
+    return self._full_path_cache[file]
 
 
   def _isNewDocument(self, file):
@@ -584,8 +1189,11 @@ class WFCatalogCollector():
       return True
     elif CONFIG['MONGO']['ALLOW_DOUBLE']:
       return True
+    elif self.mongo.uniqueFileIds:
+      # Enforced by the unique index when writing
+      return True
     else:
-      return self.mongo.getDocumentByFilename(file).count() == 0
+      return not self.mongo.documentExists(file)
       
 
 
@@ -596,8 +1204,10 @@ class WFCatalogCollector():
     """
 
     # Throw an exception after the timeout (UNIX only)
-    signal.signal(signal.SIGALRM, handler)
-    signal.alarm(CONFIG['PROCESSING_TIMEOUT'])
+    # when the handler could be registered for this process
+    timeout = signal.getsignal(signal.SIGALRM) is handler
+    if timeout:
+      signal.alarm(CONFIG['PROCESSING_TIMEOUT'])
 
     try:
       # Catch mSEED reading warnings
@@ -614,7 +1224,8 @@ class WFCatalogCollector():
 
     finally:
       # Disable alarm
-      signal.alarm(0)
+      if timeout:
+        signal.alarm(0)
 
     return metadata.meta
 
@@ -623,8 +1234,8 @@ class WFCatalogCollector():
     """
     WFCatalogCollector._collectMetadata
     > collects the metadata from the ObsPy mseedMetadata class
+    > returns the daily and hourly documents or None on failure
     """
-    self.file_counter += 1
 
     if not os.path.isfile(file):
       self.log.info("File no longer exists in archive %s" % os.path.basename(file))
@@ -638,6 +1249,9 @@ class WFCatalogCollector():
       self.log.error(ex)
       return
 
+    # Let the kernel read all neighbouring files concurrently
+    self._prefetchFiles(fas['files'])
+
     # Get the daily granulated waveform metadata
     try:
       granule = fas['segments']['daily']
@@ -660,11 +1274,32 @@ class WFCatalogCollector():
           self.log.error("Could not get hourly metadata for %s" % os.path.basename(file)) 
           self.log.error(ex) 
 
-    # Store the documents
-    self._storeOutput({
+    return {
       'daily': daily_meta,
       'hourly': hourly_meta_array
-    })
+    }
+
+
+  def _prefetchFiles(self, files):
+    """
+    WFCatalogCollector._prefetchFiles
+    > asks the kernel to read files to the page cache in the
+    > background so ObsPy and the checksum do not wait on disk
+    """
+
+    # Available from Python 3.3 (UNIX only)
+    if not hasattr(os, 'posix_fadvise'):
+      return
+
+    for f in files:
+      try:
+        fd = os.open(f, os.O_RDONLY)
+        try:
+          os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+          os.close(fd)
+      except OSError:
+        pass
 
 
   def _storeOutput(self, documents):
@@ -701,36 +1336,90 @@ class WFCatalogCollector():
       self.log.error("Stop: document with this id is already in the database: %s" % documents['daily']['fileId'])
       return
 
-    # Store the daily output and get the parentID
+    # Dublin Core data objects are shared between files and stored here
+    if CONFIG['ENABLE_DUBLIN_CORE']:
+      try:
+        for document in [documents['daily']] + documents['hourly']:
+          for used_file in document['files']:
+            used_file['do'] = self._getFileDataObject(used_file['name'])
+      except Exception as ex:
+        self.log.error("Could not store data objects for %s" % documents['daily']['fileId'])
+        self.log.exception(ex)
+        return
+
+    # Queue the daily output and link the hourly granules
+    # and continuous segments to its id
+    id = self.mongo._storeGranule(documents['daily'], 'daily')
+
+    hourly_granules = documents['hourly']
+    for granule in hourly_granules:
+      granule['streamId'] = id
+    self.mongo._storeGranules(hourly_granules, 'hourly')
+
+    segments = documents['c_segments']
+    for segment in segments:
+      segment['streamId'] = id
+    self.mongo.storeContinuousSegments(segments)
+
+    # Write all documents of this file in one bulk write per collection
     try:
-      qc_metadata_daily = self._getDatabaseKeyMap(documents['daily'], None)
-      id = self.mongo._storeGranule(qc_metadata_daily, 'daily')
-      self.log.info("Succesfully stored daily granule %s" % id)
+      failed = self.mongo.flush()
+    except DuplicateKeyError:
+      self.log.error("Stop: document with this id is already in the database: %s" % documents['daily']['fileId'])
+      return
     except Exception as ex:
       self.log.error("Could not store daily granule document to database")
       self.log.exception(ex)
       return
 
-    # Store the hourly output
+    self.log.info("Succesfully stored daily granule %s" % id)
+
+    for collection, (lost, ex) in failed.items():
+      self.log.error("Could not store %d document(s) in %s for daily granule %s" % (lost, collection, id))
+      self.log.error(ex)
+
+    if hourly_granules and 'hourly_streams' not in failed:
+      self.log.info("Succesfully stored %d hourly granule(s)" % len(hourly_granules))
+
+    if segments and 'c_segments' not in failed:
+      self.log.info("Succesfully stored %d continuous segment(s) to database" % len(segments))
+
+
+  def _getDatabaseDocuments(self, metadata):
+    """
+    WFCatalogCollector._getDatabaseDocuments
+    > builds the daily, hourly and continuous segment documents of a file
+    > the parent id is set when the documents are stored
+    """
+
+    # The file entries are shared by all granules of the file
+    usedFiles = {}
+
+    daily = self._getDatabaseKeyMap(metadata['daily'], None, usedFiles)
+
+    hourly = []
     if self.args['hourly']:
-      for i, granule in enumerate(documents['hourly']):
+      for granule in metadata['hourly']:
         try:
-          qc_metadata = self._getDatabaseKeyMap(granule, id)
-          self.mongo._storeGranule(qc_metadata, 'hourly')
-          self.log.info("[%d/%d] Succesfully stored hourly granule" % (i + 1, len(documents['hourly'])))
+          hourly.append(self._getDatabaseKeyMap(granule, None, usedFiles))
         except Exception as ex:
-          self.log.error("Could not store hourly granule document to database")
+          self.log.error("Could not parse hourly granule document")
           self.log.exception(ex)
 
-    # Store continuous segments if the metadata is not continuous
-    if self.args['csegs'] and not qc_metadata_daily['cont']:
-      for segment in documents['daily']['c_segments']:
+    # Continuous segments if the metadata is not continuous
+    segments = []
+    if self.args['csegs'] and not daily['cont']:
+      for segment in metadata['daily']['c_segments']:
         try:
-          qc_metadata = self._getDatabaseKeyMapContinuous(segment, id)
-          self.mongo.storeContinuousSegment(qc_metadata)
+          segments.append(self._getDatabaseKeyMapContinuous(segment, None))
         except Exception as ex:
-          self.log.exception("Could not store continuous segment to database")
-      self.log.info("Succesfully stored %d continuous segment(s) to database" % len(documents['daily']['c_segments']))
+          self.log.exception("Could not parse continuous segment")
+
+    return {
+      'daily': daily,
+      'hourly': hourly,
+      'c_segments': segments
+    }
 
 
   def _getDatabaseKeyMapContinuous(self, trace, id):
@@ -742,28 +1431,21 @@ class WFCatalogCollector():
     # Source object for a continuous segment
     source = {
       'streamId': id,
-      'smin': int(trace['sample_min']),
-      'smax': int(trace['sample_max']),
-      'smean': float(trace['sample_mean']),
-      'smedian': float(trace['sample_median']),
-      'stdev': float(trace['sample_stdev']),
-      'rms': float(trace['sample_rms']),
-      'supper': float(trace['sample_upper_quartile']),
-      'slower': float(trace['sample_lower_quartile']),
-      'nsam': int(trace['num_samples']),
-      'srate': float(trace['sample_rate']),
       'ts': trace['start_time'].datetime,
-      'te': trace['end_time'].datetime,
-      'slen': float(trace['segment_length'])
+      'te': trace['end_time'].datetime
     }
 
+    for key, cast, metric in CONTINUOUS_FIELDS:
+      source[key] = cast(trace[metric])
+
     return source
 
 
-  def _getDatabaseKeyMap(self, trace, id):
+  def _getDatabaseKeyMap(self, trace, id, usedFiles=None):
     """
     WFCatalogCollector._getDatabaseKeyMap
     > document parser for daily and hourly granules
+    > file entries are reused from usedFiles when given
     """
 
     nSegments = len(trace.get('c_segments') or [])
@@ -789,27 +1471,17 @@ class WFCatalogCollector():
       'enc': trace['encoding'],
       'srate': trace['sample_rate'],
       'rlen': trace['record_length'], 
-      'nrec': int(trace['num_records']) if trace['num_records'] is not None else None,
-      'nsam': int(trace['num_samples']),
-      'smin': int(trace['sample_min']),
-      'smax': int(trace['sample_max']),
-      'smean': float(trace['sample_mean']),
-      'smedian': float(trace['sample_median']),
-      'supper': float(trace['sample_upper_quartile']),
-      'slower': float(trace['sample_lower_quartile']),
-      'rms': float(trace['sample_rms']),
-      'stdev': float(trace['sample_stdev']), 
-      'ngaps': int(trace['num_gaps']),
-      'glen': float(trace['sum_gaps']),
-      'nover': int(trace['num_overlaps']),
-      'olen': float(trace['sum_overlaps']),
-      'gmax': float(trace['max_gap']) if trace['max_gap'] is not None else None,
-      'omax': float(trace['max_overlap']) if trace['max_overlap'] is not None else None,
-      'avail': float(trace['percent_availability']),
       'sgap': trace['start_gap'] is not None,
       'egap': trace['end_gap'] is not None
     }
 
+    for key, cast, metric in GRANULE_FIELDS:
+      source[key] = cast(trace[metric])
+
+    for key, cast, metric in OPTIONAL_GRANULE_FIELDS:
+      value = trace[metric]
+      source[key] = None if value is None else cast(value)
+
     # Add parent streamId if it is given, this links
     # the daily stream to hourly granules
     if id is not None:
@@ -817,25 +1489,47 @@ class WFCatalogCollector():
 
     # Add the miniseed header percentages and timing quality
     if self.args['flags']:
-      source.update(self._getTimingQuality(trace))
-      source.update(self._getFlags(trace))
+      source.update(getHeaderDocument(trace['miniseed_header_percentages']))
 
     # Add file list and checksums
-    source.update(self._getFileChecksums(trace['files']))
+    source.update(self._getFileChecksums(trace['files'], usedFiles))
 
     return source
 
 
-  def _getFileChecksums(self, files):
+  def _getFileChecksums(self, files, usedFiles=None):
     """
     WFCatalogCollector._getFileChecksums
     returns files and checksums from the trace
+    > entries are built once per file and kept in usedFiles
     """
 
-    if CONFIG['ENABLE_DUBLIN_CORE']:
-      return {'files': [{'do': self._getFileDataObject(f), 'name': os.path.basename(f), 'chksm': self._getMD5Hash(f)} for f in files]}
-    else:
-      return {'files': [{'name': os.path.basename(f), 'chksm': self._getMD5Hash(f)} for f in files]}
+    if usedFiles is None:
+      usedFiles = {}
+
+    documents = []
+
+    for f in files:
+
+      if f not in usedFiles:
+
+        # Size and modification time let updates skip hashing unchanged files
+        fingerprint = self._getFingerprint(f)
+
+        document = {
+          'name': os.path.basename(f),
+          'chksm': self._cachedChecksum(f, CONFIG['CHECKSUM_ALGO'], fingerprint),
+          'algo': CONFIG['CHECKSUM_ALGO']
+        }
+
+        if fingerprint is not None:
+          document['fsize'], document['fmtime_ns'] = fingerprint
+
+        usedFiles[f] = document
+
+      documents.append(dict(usedFiles[f]))
+
+    return {'files': documents}
 
 
   def _getFileDataObject(self, file):
@@ -844,12 +1538,20 @@ class WFCatalogCollector():
     Get the id of the data object or store a new one
     """
 
+    key = os.path.basename(file)
+
+    if key in self._data_object_cache:
+      return self._data_object_cache[key]
+
     # If the extension exists in the table
     for document in self.mongo.getFileDataObject(file):
+      self._data_object_cache[key] = document['_id']
       return document['_id']
 
     # Otherwise create it
-    return self.mongo._storeFileDataObject(self._createDataObject(file))
+    self._data_object_cache[key] = self.mongo._storeFileDataObject(self._createDataObject(file))
+
+    return self._data_object_cache[key]
   
 
   def _createDataObject(self, file):
@@ -881,135 +1583,185 @@ class WFCatalogCollector():
     return document
 
 
-  def _getTimingQuality(self, trace):
+  def _getFingerprint(self, f):
     """
-    WFCatalogCollector._getTimingQuality
-    writes timing quality parameters and correction to source document
+    WFCatalogCollector._getFingerprint
+    > Returns (size, modification time in ns) of a file
+    > or None when the file cannot be accessed
     """
+    try:
+      stat = os.stat(f)
+    except OSError:
+      return None
 
-    trace = trace['miniseed_header_percentages']
+    # st_mtime_ns is not available on Python 2
+    try:
+      mtime_ns = stat.st_mtime_ns
+    except AttributeError:
+      mtime_ns = int(stat.st_mtime * 1e9)
 
-    # Add the timing correction
-    source = {'tcorr': float(trace['timing_correction'])}
+    return (stat.st_size, mtime_ns)
 
-    # Check if the minimum is None, so is the rest
-    # otherwise convert to floats
-    if trace['timing_quality_min'] is None:
 
-      source.update({
-        'tqmin': None,
-        'tqmax': None,
-        'tqmean': None,
-        'tqmedian': None,
-        'tqupper': None,
-        'tqlower': None
-      })
+  def _cachedChecksum(self, f, algorithm, fingerprint=None):
+    """
+    WFCatalogCollector._cachedChecksum
+    > Returns the checksum of a file and caches it by
+    > path, size, modification time and algorithm
+    > the fingerprint is read when it is not given
+    """
+    if fingerprint is None:
+      fingerprint = self._getFingerprint(f)
+
+    if fingerprint is None:
+      self.log.error("Could not access file %s" % f)
+      return None
 
+    key = (f, fingerprint, algorithm)
+
+    if key in self._checksum_cache:
+      return self._checksum_cache[key]
+
+    if algorithm == 'md5':
+      checksum = self._getMD5Hash(f)
+    elif algorithm == 'sha256':
+      checksum = self._getHashlibHash(f, 'sha256')
+    elif algorithm == 'blake3':
+      checksum = self._getBlake3Hash(f)
     else:
+      self.log.error("Unknown checksum algorithm %s" % algorithm)
+      return None
 
-      source.update({
-        'tqmin': float(trace['timing_quality_min']),
-        'tqmax': float(trace['timing_quality_max']),
-        'tqmean': float(trace['timing_quality_mean']),
-        'tqmedian': float(trace['timing_quality_median']),
-        'tqupper': float(trace['timing_quality_upper_quartile']),
-        'tqlower': float(trace['timing_quality_lower_quartile'])
-      })
+    if checksum is not None:
+      self._checksum_cache[key] = checksum
 
-    return source
+    return checksum
 
 
-  def _getFlags(self, trace):
+  def _getMD5Hash(self, f):
+    """
+    WFCatalogCollector._getMD5Hash
+    > Method to generate md5 hashes used 
+    > for the checksum field
     """
-    WFCatalogCollector._getFlags
-    writes mSEED header flag percentages to source document
-    """    
-
-    header = trace['miniseed_header_percentages']
 
-    source = {
-      'io_flags': self._getFlagKeys(header, 'io_and_clock_flags'),
-      'dq_flags': self._getFlagKeys(header, 'data_quality_flags'),
-      'ac_flags': self._getFlagKeys(header, 'activity_flags')
-    } 
+    # Large files are hashed by md5sum outside of the interpreter
+    # unless direct reads are requested to keep the page cache clean
+    try:
+      if MD5SUM is not None and not CONFIG['HASH_DIRECT_IO'] and os.path.getsize(f) > MD5SUM_MIN_SIZE:
+        return subprocess.check_output([MD5SUM, f]).split()[0].decode('ascii')
+    except Exception as ex:
+      self.log.error(ex)
+      return None
 
-    return source
+    return self._getHashlibHash(f, 'md5')
 
 
-  def _getFlagKeys(self, trace, flag_type):
+  def _getHashlibHash(self, f, algorithm):
     """
-    mSEEDMetadataCollector._getFlagKeys
-    returns MongoDB document structure for miniseed header percentages
+    WFCatalogCollector._getHashlibHash
+    > Method to generate hashes of a file with a hashlib
+    > algorithm (OpenSSL uses SHA extensions for sha256)
     """
 
-    trace = trace[flag_type]
-
-    if flag_type == 'activity_flags':
-
-      source = {
-        'cas': trace['calibration_signal'],
-        'tca': trace['time_correction_applied'],
-        'evb': trace['event_begin'],
-        'eve': trace['event_end'],
-        'eip': trace['event_in_progress'],
-        'pol': trace['positive_leap'],
-        'nel': trace['negative_leap']
-      }  
+    # Bypass the page cache when configured and supported
+    if CONFIG['HASH_DIRECT_IO']:
+      try:
+        checksum = self._getDirectHash(f, algorithm)
+        if checksum is not None:
+          return checksum
+      except Exception as ex:
+        self.log.error(ex)
+        return None
 
-    elif flag_type == 'data_quality_flags':
+    try:
+      with open(f, 'rb', buffering=0) as afile:
+
+        # Python 3.11+ hashes the file inside OpenSSL
+        if hasattr(hashlib, 'file_digest'):
+          return hashlib.file_digest(afile, algorithm).hexdigest()
+
+        # Read into one reused buffer instead of a new bytes object per block
+        BLOCKSIZE = 1 << 20
+        hasher = hashlib.new(algorithm)
+        buf = memoryview(bytearray(BLOCKSIZE))
+        size = afile.readinto(buf)
+        while size > 0:
+          hasher.update(buf[:size])
+          size = afile.readinto(buf)
+    except Exception as ex:
+      self.log.error(ex)
+      return None
 
-      source = {
-        'asa': trace['amplifier_saturation'],
-        'dic': trace['digitizer_clipping'],
-        'spi': trace['spikes'],
-        'gli': trace['glitches'],
-        'mpd': trace['missing_padded_data'],
-        'tse': trace['telemetry_sync_error'],
-        'dfc': trace['digital_filter_charging'],
-        'stt': trace['suspect_time_tag']
-      }
+    return hasher.hexdigest()
 
-    elif flag_type == 'io_and_clock_flags':
 
-      source = {
-        'svo': trace['station_volume'],
-        'lrr': trace['long_record_read'],
-        'srr': trace['short_record_read'],
-        'sts': trace['start_time_series'],
-        'ets': trace['end_time_series'],
-        'clo': trace['clock_locked']
-      }
+  def _getDirectHash(self, f, algorithm):
+    """
+    WFCatalogCollector._getDirectHash
+    > Hashes a file with O_DIRECT reads into a page aligned buffer so the
+    > read does not evict the files ObsPy is reading from the page cache.
+    > Returns None when the platform or file system does not support it
+    """
 
-    else:
-      raise Exception("Unknown flag type in mSEEDMetadataCollector._getFlagKeys")
+    if not hasattr(os, 'O_DIRECT'):
+      return None
 
-    # Make sure the flags are floats
-    for flag in source:
-      source[flag] = float(source[flag])
+    try:
+      fd = os.open(f, os.O_RDONLY | os.O_DIRECT)
+    except OSError as ex:
+      if ex.errno == errno.EINVAL:
+        return None
+      raise
+
+    # Anonymous memory maps are page aligned as required by O_DIRECT
+    BLOCKSIZE = 1 << 20
+    buf = mmap.mmap(-1, BLOCKSIZE)
+    hasher = hashlib.new(algorithm)
+
+    with io.open(fd, 'rb', buffering=0) as afile:
+      try:
+        size = afile.readinto(buf)
+        while size > 0:
+          hasher.update(buf[:size])
+          size = afile.readinto(buf)
+      except (IOError, OSError) as ex:
+        if ex.errno == errno.EINVAL:
+          return None
+        raise
+      finally:
+        buf.close()
 
-    return source
+    return hasher.hexdigest()
 
 
-  def _getMD5Hash(self, f):
+  def _getBlake3Hash(self, f):
     """
-    WFCatalogCollector._getMD5Hash
-    > Method to generate md5 hashes used 
-    > for the checksum field
+    WFCatalogCollector._getBlake3Hash
+    > Method to generate BLAKE3 hashes over a
+    > memory map of the file without copying
     """
     try:
-      BLOCKSIZE = 65536
-      hasher = hashlib.md5()
+
+      # Recent versions map the file and hash it on all cores
+      if hasattr(blake3, 'update_mmap'):
+        return blake3(max_threads=blake3.AUTO).update_mmap(f).hexdigest()
+
       with open(f, 'rb') as afile:
-        buf = afile.read(BLOCKSIZE)
-        while len(buf) > 0:
-          hasher.update(buf)
-          buf = afile.read(BLOCKSIZE)
+
+        # Empty files cannot be memory mapped
+        if os.fstat(afile.fileno()).st_size == 0:
+          return blake3().hexdigest()
+
+        mapped = mmap.mmap(afile.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+          return blake3(mapped).hexdigest()
+        finally:
+          mapped.close()
     except Exception as ex:
       self.log.error(ex)
       return None
 
-    return hasher.hexdigest()
-
 
   def _getStatsObject(self, file):
     """
@@ -1017,34 +1769,19 @@ class WFCatalogCollector():
     returns object with stream metadata depending on archive struture
     """
     
-    statsArray = file.split(".")
-
     if CONFIG['STRUCTURE'] == 'ODC':
-
-      stats_object = {
-        'jday': statsArray.pop(),
-        'year': statsArray.pop(),
-        'network': statsArray.pop(),
-        'channel': statsArray.pop(),
-        'station': statsArray.pop()
-      }
+      match = self._ODC_RE.match(file)
 
     elif CONFIG['STRUCTURE'] == 'SDS':
-
-      stats_object = {
-        'jday': statsArray.pop(),
-        'year': statsArray.pop(),
-        'dtype': statsArray.pop(),
-        'channel': statsArray.pop(),
-        'location': statsArray.pop(),
-        'station': statsArray.pop(),
-        'network': statsArray.pop()
-      }
+      match = self._SDS_RE.match(file)
 
     else:
       raise Exception("Unknown directory structure in mSEEDMetadataCollector._getStatsObject")
 
-    return stats_object
+    if match is None:
+      raise Exception("File name %s does not match the %s structure" % (file, CONFIG['STRUCTURE']))
+
+    return match.groupdict()
        
 
   def _getFilename(self, stats):
@@ -1091,6 +1828,10 @@ class WFCatalogCollector():
 
     # For daily granularity take steps of 24h
     self.gran = 1 if self.args['hourly'] else 24
+
+    # Offsets of the granules from the start of a day
+    self._granuleStep = datetime.timedelta(hours=self.gran)
+    self._granuleOffsets = [datetime.timedelta(hours=hour) for hour in range(0, 24, self.gran)]
  
 
   def _getNextFile(self, file, direction):
@@ -1100,11 +1841,12 @@ class WFCatalogCollector():
     """
 
     stats = self._getStatsObject(os.path.basename(file))
-    current_date = datetime.datetime.strptime(stats['year'] + " " + stats['jday'], '%Y %j')
+    current_date = datetime.datetime(int(stats['year']), 1, 1) + datetime.timedelta(days=int(stats['jday']) - 1)
     new_date = current_date + datetime.timedelta(days=direction)
 
-    stats['year'] = new_date.strftime('%Y')
-    stats['jday'] = new_date.strftime('%j')
+    # Formatting by hand is much cheaper than strftime
+    stats['year'] = '%04d' % new_date.year
+    stats['jday'] = '%03d' % new_date.timetuple().tm_yday
 
     return self._getFileDirectory(stats)
 
@@ -1116,7 +1858,9 @@ class WFCatalogCollector():
     """
 
     stats = self._getStatsObject(os.path.basename(file))
-    return datetime.datetime.strptime(stats['year'] + " " + stats['jday'], '%Y %j')
+
+    # Avoid strptime, which parses the format string on every call
+    return datetime.datetime(int(stats['year']), 1, 1) + datetime.timedelta(days=int(stats['jday']) - 1)
 
 
   def _getFileSegments(self, file):
@@ -1136,12 +1880,7 @@ class WFCatalogCollector():
     # Taking 1h steps
     hourly = []
     if self.args['hourly']:
-
-      while start_time < end_time:
-
-        segment_end = start_time + datetime.timedelta(hours=self.gran)
-        hourly.append({'start': start_time, 'end': segment_end})
-        start_time = segment_end
+      hourly = [{'start': start_time + offset, 'end': start_time + offset + self._granuleStep} for offset in self._granuleOffsets]
 
     return {'daily': daily, 'hourly': hourly}
 
@@ -1155,6 +1894,30 @@ class WFCatalogCollector():
     print(json.dumps(CONFIG, indent=2))
 
 
+  def _fileExists(self, file):
+    """
+    WFCatalogCollector._fileExists
+    > checks whether a file exists against a cached listing of its
+    > directory so neighbouring files do not cost a stat each
+    > a directory is only listed when it is looked in again
+    """
+
+    directory, filename = os.path.split(file)
+
+    # A single stat is cheaper than listing the directory
+    if directory not in self._listing_cache:
+      self._listing_cache[directory] = None
+      return os.path.isfile(file)
+
+    if self._listing_cache[directory] is None:
+      try:
+        self._listing_cache[directory] = set(entry.name for entry in listEntries(directory or '.') if entry.is_file())
+      except OSError:
+        self._listing_cache[directory] = set()
+
+    return filename in self._listing_cache[directory]
+
+
   def _collectFilesAndSegments(self, file):
     """
     WFCatalogCollector._collectFilesAndSegments
@@ -1166,7 +1929,7 @@ class WFCatalogCollector():
     # Append three files to array in order [yesterday, today, tomorrow]
     # Get yesterdays file
     previous_file = self._getNextFile(file, -1)
-    if os.path.isfile(previous_file):
+    if self._fileExists(previous_file):
       day_files.append(previous_file)
 
     # Add todays file
@@ -1174,10 +1937,13 @@ class WFCatalogCollector():
 
     # Get tomorrows file
     next_file = self._getNextFile(file, 1)
-    if os.path.isfile(next_file):
+    if self._fileExists(next_file):
       day_files.append(next_file)
 
-    self.log.info("[%d/%d] File %s prepared with %s" % (self.file_counter, self.totalFiles, os.path.basename(file), [os.path.basename(f) for f in day_files]))
+    # The total is unknown when files are streamed
+    totalFiles = "?" if self.totalFiles is None else self.totalFiles
+
+    self.log.info("[%d/%s] File %s prepared with %s" % (self.file_counter, totalFiles, os.path.basename(file), [os.path.basename(f) for f in day_files]))
 
     return {'files': day_files, 'segments': self._getFileSegments(file)}
 
@@ -1194,7 +1960,24 @@ class MongoDatabase():
     > sets the configured host
     """
     self.host = CONFIG['MONGO']['DB_HOST']
+    self.client = None
+    self._connected = False
+    self.uniqueFileIds = False
+    self.db = None
+    self._pending = {'daily_streams': [], 'hourly_streams': [], 'c_segments': []}
+
+
+  def _resetAfterFork(self):
+    """
+    MongoDatabase._resetAfterFork
+    > MongoClient is not fork safe: a child inheriting a connected
+    > instance drops the client and database, which are both
+    > created again by the next _connect
+    """
+    self.client = None
+    self.db = None
     self._connected = False
+    self._pending = {'daily_streams': [], 'hourly_streams': [], 'c_segments': []}
 
 
   def _connect(self):
@@ -1206,14 +1989,63 @@ class MongoDatabase():
     if self._connected:
       return
 
-    self.client = MongoClient(self.host)
+    options = {'w': 1, 'j': False, 'connect': False}
+
+    # Optional wire protocol compression of the documents
+    if CONFIG['MONGO']['COMPRESSORS']:
+      options['compressors'] = CONFIG['MONGO']['COMPRESSORS']
+
+    self.client = MongoClient(self.host, **options)
     self.db = self.client[CONFIG['MONGO']['DB_NAME']]
 
     if CONFIG['MONGO']['AUTHENTICATE']:
       self.db.authenticate(CONFIG['MONGO']['USER'], CONFIG['MONGO']['PASS'])
 
+    self._createIndexes()
+
     self._connected = True
 
+
+  def _createIndexes(self):
+    """
+    MongoDatabase._createIndexes
+    > makes sure the fields used in queries are indexed
+    """
+
+    # Let the server reject double daily streams unless they are allowed
+    # Existing databases with double streams or a non-unique index
+    # keep the plain index and are checked before every write
+    self.uniqueFileIds = False
+    if not CONFIG['MONGO']['ALLOW_DOUBLE']:
+      try:
+        self.db.daily_streams.create_index([('fileId', 1)], unique=True, background=True)
+        self.uniqueFileIds = True
+      except OperationFailure:
+        pass
+
+    if not self.uniqueFileIds:
+      self.db.daily_streams.create_index([('fileId', 1)], background=True)
+
+    self.db.daily_streams.create_index([('files.name', 1)], background=True)
+    self.db.hourly_streams.create_index([('streamId', 1)], background=True)
+    self.db.c_segments.create_index([('streamId', 1)], background=True)
+
+
+  def getIndexStats(self):
+    """
+    MongoDatabase.getIndexStats
+    > returns (collection, index, operations, since) for
+    > all indexes of the collections written by the collector
+    """
+
+    stats = []
+
+    for collection in ['daily_streams', 'hourly_streams', 'c_segments']:
+      for index in self.db[collection].aggregate([{'$indexStats': {}}]):
+        stats.append((collection, index['name'], index['accesses']['ops'], index['accesses']['since']))
+
+    return stats
+
   def getFileDataObject(self, file):
     """
     MongoDatabase.getFileDataObject
@@ -1225,18 +2057,97 @@ class MongoDatabase():
     MongoDatabase._storeFileDataObject
     stored data object to wf_do collection
     """  
-    return self.db.wf_do.save(obj)
+    return self.db.wf_do.insert_one(obj).inserted_id
 
   def _storeGranule(self, stream, granule):
     """
     MongoDatabase._storeGranule
-    > stores daily and hourly granules to collections
+    > queues daily and hourly granules for the next flush
+    > and returns the granule ObjectId
+    """
+
+    if '_id' not in stream:
+      stream['_id'] = ObjectId()
+
+    operation = ReplaceOne({'_id': stream['_id']}, stream, upsert=True)
+
+    if granule == 'daily':
+      self._pending['daily_streams'].append(operation)
+    elif granule == 'hourly':
+      self._pending['hourly_streams'].append(operation)
+
+    return stream['_id']
+
+
+  def _storeGranules(self, streams, granule):
+    """
+    MongoDatabase._storeGranules
+    > queues multiple granules for the next flush
     """
 
+    operations = [InsertOne(stream) for stream in streams]
+
     if granule == 'daily':
-      return self.db.daily_streams.save(stream)
+      self._pending['daily_streams'].extend(operations)
     elif granule == 'hourly':
-      return self.db.hourly_streams.save(stream)
+      self._pending['hourly_streams'].extend(operations)
+
+
+  def flush(self):
+    """
+    MongoDatabase.flush
+    > writes all queued documents with one bulk write per collection,
+    > daily streams first so children never exist without a parent
+    > returns {collection: (number of lost documents, exception)} for
+    > the child collections that could not be written
+    """
+
+    failed = {}
+
+    try:
+
+      # A failure of the parents is raised and stops the children
+      try:
+        if self._pending['daily_streams']:
+          self._getCollection('daily_streams').bulk_write(self._pending['daily_streams'], ordered=False)
+      except BulkWriteError as ex:
+        # Double daily streams rejected by the unique index
+        errors = ex.details.get('writeErrors', [])
+        if errors and all(error['code'] == 11000 for error in errors):
+          raise DuplicateKeyError(errors[0]['errmsg'], 11000)
+        raise
+
+      # Every child collection is written independently
+      for collection in ['hourly_streams', 'c_segments']:
+        documents = self._pending[collection]
+        if not documents:
+          continue
+        try:
+          self._getCollection(collection).bulk_write(documents, ordered=False)
+        except BulkWriteError as ex:
+          failed[collection] = (len(ex.details.get('writeErrors', [])), ex)
+        except Exception as ex:
+          failed[collection] = (len(documents), ex)
+
+    finally:
+      for collection in self._pending:
+        self._pending[collection] = []
+
+    return failed
+
+
+  def _getCollection(self, collection):
+    """
+    MongoDatabase._getCollection
+    > returns the collection to write to; hourly granules and continuous
+    > segments are written without acknowledgement when configured.
+    > Daily streams are always acknowledged as the parent of the others
+    """
+
+    if CONFIG['MONGO']['UNACKNOWLEDGED_WRITES'] and collection != 'daily_streams':
+      return self.db.get_collection(collection, write_concern=WriteConcern(w=0))
+
+    return self.db[collection]
 
 
   def removeDocumentsById(self, id):
@@ -1252,9 +2163,17 @@ class MongoDatabase():
   def storeContinuousSegment(self, segment):
     """
     MongoDatabase.storeContinuousSegment
-    > Saves a continuous segment to collection
+    > Queues a continuous segment for the next flush
+    """
+    self._pending['c_segments'].append(InsertOne(segment))
+
+
+  def storeContinuousSegments(self, segments):
+    """
+    MongoDatabase.storeContinuousSegments
+    > Queues continuous segments for the next flush
     """
-    self.db.c_segments.save(segment)
+    self._pending['c_segments'].extend(InsertOne(segment) for segment in segments)
 
 
   def getDailyFilesById(self, file):
@@ -1265,6 +2184,34 @@ class MongoDatabase():
     return self.db.daily_streams.find({'files.name': os.path.basename(file)}, {'files': 1, 'fileId': 1, '_id': 1})
 
 
+  def getDailyFilesByIds(self, files):
+    """
+    MongoDatabase.getDailyFilesByIds
+    returns all documents that include any of the files in the metadata calculation
+    """
+    return self.db.daily_streams.find({'files.name': {'$in': [os.path.basename(f) for f in files]}}, {'files': 1, 'fileId': 1, '_id': 1})
+
+
+  def getExistingFileIds(self, files):
+    """
+    MongoDatabase.getExistingFileIds
+    returns the set of file identifiers already in the database
+    """
+    existing = set()
+    for batch in inBatches(os.path.basename(f) for f in files):
+      query = {'fileId': {'$in': batch}}
+      existing.update(document['fileId'] for document in self.db.daily_streams.find(query, {'fileId': 1}))
+    return existing
+
+
+  def documentExists(self, file):
+    """
+    MongoDatabase.documentExists
+    returns whether a daily stream exists for a file
+    """
+    return self.db.daily_streams.find_one({'fileId': os.path.basename(file)}, {'_id': 1}) is not None
+
+
   def getDocumentByFilename(self, file):
     """
     MongoDatabase.getDocumentByFilename
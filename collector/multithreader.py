@@ -1,6 +1,6 @@
 import os
 from multiprocessing import Pool
-from WFCatalogCollector import WFCatalogCollector
+from WFCatalogCollector import WFCatalogCollector, walkFiles, largestFirst
 
 import datetime
 
@@ -10,10 +10,18 @@ Example multithreading script for WFCatalogCollector.py
 Author: Mathijs Koymans, KNMI 2017
 """
 
+# The collectors in the worker processes ignore the WORKERS
+# option of config.json and process their files serially
 NUMBER_OF_PROCESSES = 4
 
 MetadataCollector = WFCatalogCollector("./logs/multithreader-master.log")
 
+def WFCatalogWorkerInit():
+
+  # Every worker creates its own database client once and
+  # reuses it for all files instead of the one inherited by fork
+  MetadataCollector.mongo._resetAfterFork()
+
 def WFCatalogWork(filename):
 
   try:
@@ -34,10 +42,16 @@ if __name__ == "__main__":
   files = MetadataCollector._collectFilesFromDate(datetime.datetime.now() - datetime.timedelta(days=1))
 
   # Or files from a directory
-  #files = [os.path.join(root, f) for root, dirs, files in os.walk("/data/storage/orfeus/SDS/2016/EC") for f in files if os.path.isfile(os.path.join(root, f))]
+  #files = list(walkFiles("/data/storage/orfeus/SDS/2016/EC"))
+
+  # Start the largest files first and hand them out one at a time so no worker
+  # is left with a batch of large files at the end. Workers are recycled to
+  # release memory held by ObsPy
+  files = largestFirst(files)
 
   # Create a pool and map the work across the pool
-  pool = Pool(processes=NUMBER_OF_PROCESSES)
-  pool.map(WFCatalogWork, files)
+  pool = Pool(processes=NUMBER_OF_PROCESSES, initializer=WFCatalogWorkerInit, maxtasksperchild=50)
+  for _ in pool.imap_unordered(WFCatalogWork, files, chunksize=1):
+    pass
   pool.close()
   pool.join()